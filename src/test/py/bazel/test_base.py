@@ -191,9 +191,7 @@ class TestBase(unittest.TestCase):
     self.ScratchDir(os.path.dirname(path))
     with open(abspath, 'w') as f:
       if lines:
-        for l in lines:
-          f.write(l)
-          f.write('\n')
+        f.write(''.join(l + '\n' for l in lines))
     if executable:
       os.chmod(abspath, stat.S_IRWXU)
     return abspath
@@ -12,24 +12,99 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import itertools
 import os
+import re
 import unittest
 
 from src.test.py.bazel import test_base
 
+# Prefixes of the lines that foo/printing.bat prints.
+_PRINTING_TEST_PREFIXES = ('lorem ipsum', 'HOME=', 'TEST_SRCDIR=',
+                           'TEST_TMPDIR=', 'USER=')
+
+# Matches the lines that the test scripts print. Group 1 is the prefix or key,
+# group 2 is the rest of the line.
+_PRINTING_TEST_RE = re.compile(
+    '(%s)(.*)$' % '|'.join(re.escape(p) for p in _PRINTING_TEST_PREFIXES))
+_RUNFILES_TEST_RE = re.compile(r'(MF|ONLY|DIR)=(.*)$')
+_SHARDED_TEST_RE = re.compile(r'(STATUS|INDEX)=(.*)$')
+_UNEXPORTED_TEST_RE = re.compile(r'(GOOD|BAD)=(.*)$')
+
+# Lines that the two shards of foo/sharded.bat print, in any order.
+_SHARDED_TEST_INDEX_LINES = frozenset(('INDEX=0 TOTAL=2', 'INDEX=1 TOTAL=2'))
+
 
 class TestWrapperTest(test_base.TestBase):
 
+  # Scratch directory of the mock workspace, shared by all test methods.
+  _workspace = None
+
+  # The most recently finished test, used to shut down the Bazel server.
+  _last_test = None
+
+  # Bazel arguments for running the tests, without the test wrapper flag.
+  _TEST_ARGS = (
+      'test',
+      '//foo:all_tests',
+      '-t-',
+      # Keep Bazel's output short, but still print the logs of failing tests.
+      '--noshow_progress',
+      '--noshow_loading_progress',
+      '--test_output=errors',
+      # Ensure Bazel does not create a runfiles tree.
+      '--experimental_enable_runfiles=no',
+  )
+
+  def setUp(self):
+    test_base.TestBase.setUp(self)
+    if TestWrapperTest._workspace is None:
+      self._CreateMockWorkspace()
+      TestWrapperTest._workspace = self._test_cwd
+    else:
+      # The test methods don't modify the workspace, so reuse it instead of
+      # writing the same files again.
+      self._test_cwd = TestWrapperTest._workspace
+      os.chdir(self._test_cwd)
+
+  def tearDown(self):
+    # Keep the Bazel server running: all test methods share the workspace and
+    # thus the output base, so the next test method can reuse the server.
+    TestWrapperTest._last_test = self
+
+  @classmethod
+  def tearDownClass(cls):
+    if cls._last_test is not None:
+      cls._last_test.RunBazel(['shutdown'])
+      cls._last_test = None
+    test_base.TestBase.tearDownClass()
+
   @staticmethod
   def _ReadFile(path):
-    # Read the runfiles manifest.
-    contents = []
-    with open(path, 'rt') as f:
-      contents = [line.strip() for line in f.readlines()]
-    return contents
+    # Read the file with a single read and split the raw bytes, which is
+    # cheaper than text mode's per-line decoding.
+    with open(path, 'rb') as f:
+      data = f.read()
+    return [l.strip().decode('utf-8', 'replace') for l in data.splitlines()]
+
+  @staticmethod
+  def _ManifestHasEntry(path, suffix):
+    """Returns whether a runfile path in the manifest ends with `suffix`.
+
+    Args:
+      path: string; path of the runfiles manifest
+      suffix: bytes; the suffix to look for
+    Returns:
+      bool; True if the runfiles manifest has a matching entry
+    """
+    # Stream the manifest so that reading stops at the first match.
+    with open(path, 'rb', 1 << 20) as f:
+      return any(
+          line.split(b' ', 1)[0].rstrip().endswith(suffix) for line in f)
 
-  def _FailWithOutput(self, output):
-    self.fail('FAIL:\n | %s\n---' % '\n | '.join(output))
+  def _FailWithOutput(self, *streams):
+    self.fail('FAIL:\n | %s\n---' %
+              '\n | '.join(itertools.chain.from_iterable(streams)))
 
   def _CreateMockWorkspace(self):
     self.ScratchFile('WORKSPACE')
@@ -61,6 +136,17 @@ class TestWrapperTest(test_base.TestBase):
         '    srcs = ["unexported.bat"],',
         '    shard_count = 2,',
         ')',
+        'test_suite(',
+        '    name = "all_tests",',
+        '    tests = [',
+        '        ":passing_test.bat",',
+        '        ":failing_test.bat",',
+        '        ":printing_test.bat",',
+        '        ":runfiles_test.bat",',
+        '        ":sharded_test.bat",',
+        '        ":unexported_test.bat",',
+        '    ],',
+        ')',
     ])
     self.ScratchFile('foo/passing.bat', ['@exit /B 0'], executable=True)
     self.ScratchFile('foo/failing.bat', ['@exit /B 1'], executable=True)
@@ -93,164 +179,150 @@ class TestWrapperTest(test_base.TestBase):
         ],
         executable=True)
 
-  def _AssertPassingTest(self, flag):
-    exit_code, _, stderr = self.RunBazel([
-        'test',
-        '//foo:passing_test.bat',
-        '-t-',
-        flag,
-    ])
-    self.AssertExitCode(exit_code, 0, stderr)
-
-  def _AssertFailingTest(self, flag):
-    exit_code, _, stderr = self.RunBazel([
-        'test',
-        '//foo:failing_test.bat',
-        '-t-',
-        flag,
-    ])
+  def _RunTests(self, flag):
+    """Runs all tests in //foo with `flag` in a single Bazel invocation.
+
+    Returns:
+      ([string], [string]) tuple: stdout lines, stderr lines of Bazel
+    """
+    exit_code, stdout, stderr = self.RunBazel(
+        list(TestWrapperTest._TEST_ARGS) + [flag])
+    # failing_test.bat fails, so Bazel must report a test failure.
     self.AssertExitCode(exit_code, 3, stderr)
+    return stdout, stderr
 
-  def _AssertPrintingTest(self, flag):
-    exit_code, stdout, stderr = self.RunBazel([
-        'test',
-        '//foo:printing_test.bat',
-        '-t-',
-        '--test_output=all',
-        flag,
-    ])
-    self.AssertExitCode(exit_code, 0, stderr)
-    lorem = False
-    for line in stderr + stdout:
-      if line.startswith('lorem ipsum'):
-        lorem = True
-      elif line.startswith('HOME='):
-        home = line[len('HOME='):]
-      elif line.startswith('TEST_SRCDIR='):
-        srcdir = line[len('TEST_SRCDIR='):]
-      elif line.startswith('TEST_TMPDIR='):
-        tmpdir = line[len('TEST_TMPDIR='):]
-      elif line.startswith('USER='):
-        user = line[len('USER='):]
-    if not lorem:
-      self._FailWithOutput(stderr + stdout)
-    if not home:
-      self._FailWithOutput(stderr + stdout)
-    if not os.path.isabs(home):
-      self._FailWithOutput(stderr + stdout)
-    if not os.path.isdir(srcdir):
-      self._FailWithOutput(stderr + stdout)
-    if not os.path.isfile(os.path.join(srcdir, 'MANIFEST')):
-      self._FailWithOutput(stderr + stdout)
-    if not os.path.isabs(srcdir):
-      self._FailWithOutput(stderr + stdout)
-    if not os.path.isdir(tmpdir):
-      self._FailWithOutput(stderr + stdout)
-    if not os.path.isabs(tmpdir):
-      self._FailWithOutput(stderr + stdout)
-    if not user:
-      self._FailWithOutput(stderr + stdout)
-
-  def _AssertRunfiles(self, flag):
-    exit_code, stdout, stderr = self.RunBazel([
-        'test',
-        '//foo:runfiles_test.bat',
-        '-t-',
-        '--test_output=all',
-        # Ensure Bazel does not create a runfiles tree.
-        '--experimental_enable_runfiles=no',
-        flag,
-    ])
-    self.AssertExitCode(exit_code, 0, stderr)
-    mf = mf_only = rf_dir = None
-    for line in stderr + stdout:
-      if line.startswith('MF='):
-        mf = line[len('MF='):]
-      elif line.startswith('ONLY='):
-        mf_only = line[len('ONLY='):]
-      elif line.startswith('DIR='):
-        rf_dir = line[len('DIR='):]
-
-    if mf_only != '1':
-      self._FailWithOutput(stderr + stdout)
-
-    if not os.path.isfile(mf):
-      self._FailWithOutput(stderr + stdout)
-    mf_contents = TestWrapperTest._ReadFile(mf)
+  def _ReadTestLog(self, name, shard_count=None):
+    """Returns the output lines of the test //foo:`name`.
+
+    Args:
+      name: string; name of the test rule in //foo
+      shard_count: int; optional; the test's shard_count, if it is sharded
+    Returns:
+      [string]; lines of the test.log, or of all shards' test.log files
+    """
+    testlogs = os.path.join(self._test_cwd, 'bazel-testlogs', 'foo', name)
+    if not shard_count:
+      return TestWrapperTest._ReadFile(os.path.join(testlogs, 'test.log'))
+    lines = []
+    for i in range(1, shard_count + 1):
+      lines.extend(
+          TestWrapperTest._ReadFile(
+              os.path.join(testlogs, 'shard_%d_of_%d' % (i, shard_count),
+                           'test.log')))
+    return lines
+
+  def _AssertTestStatus(self, stdout, stderr, label, status):
+    # The test summary has a line like "<label>   PASSED in 0.3s" per test.
+    if not any(line.split()[:2] == [label, status]
+               for line in itertools.chain(stderr, stdout)):
+      self._FailWithOutput(stderr, stdout)
+
+  def _AssertPassingTest(self, stdout, stderr):
+    self._AssertTestStatus(stdout, stderr, '//foo:passing_test.bat', 'PASSED')
+
+  def _AssertFailingTest(self, stdout, stderr):
+    self._AssertTestStatus(stdout, stderr, '//foo:failing_test.bat', 'FAILED')
+
+  def _AssertPrintingTest(self, output):
+    values = {}
+    for line in output:
+      m = _PRINTING_TEST_RE.match(line)
+      if m:
+        values.setdefault(m.group(1), m.group(2))
+        if len(values) == len(_PRINTING_TEST_PREFIXES):
+          break
+    home = values.get('HOME=')
+    srcdir = values.get('TEST_SRCDIR=')
+    tmpdir = values.get('TEST_TMPDIR=')
+    if 'lorem ipsum' not in values:
+      self._FailWithOutput(output)
+    # Check os.path.isabs before the checks that stat the file system. An
+    # existing srcdir/MANIFEST file implies that srcdir is a directory.
+    if not home or not os.path.isabs(home):
+      self._FailWithOutput(output)
+    if (not srcdir or not os.path.isabs(srcdir) or
+        not os.path.isfile(os.path.join(srcdir, 'MANIFEST'))):
+      self._FailWithOutput(output)
+    if not tmpdir or not os.path.isabs(tmpdir) or not os.path.isdir(tmpdir):
+      self._FailWithOutput(output)
+    if not values.get('USER='):
+      self._FailWithOutput(output)
+
+  def _AssertRunfiles(self, output):
+    values = {}
+    for line in output:
+      m = _RUNFILES_TEST_RE.match(line)
+      if m:
+        values[m.group(1)] = m.group(2)
+        if len(values) == 3:
+          break
+    mf = values.get('MF')
+    rf_dir = values.get('DIR')
+
+    if values.get('ONLY') != '1':
+      self._FailWithOutput(output)
+
+    if not mf or not os.path.isfile(mf):
+      self._FailWithOutput(output)
     # Assert that the data dependency is listed in the runfiles manifest.
-    if not any(
-        line.split(' ', 1)[0].endswith('foo/passing.bat')
-        for line in mf_contents):
-      self._FailWithOutput(mf_contents)
-
-    if not os.path.isdir(rf_dir):
-      self._FailWithOutput(stderr + stdout)
-
-  def _AssertShardedTest(self, flag):
-    exit_code, stdout, stderr = self.RunBazel([
-        'test',
-        '//foo:sharded_test.bat',
-        '-t-',
-        '--test_output=all',
-        flag,
-    ])
-    self.AssertExitCode(exit_code, 0, stderr)
+    if not TestWrapperTest._ManifestHasEntry(mf, b'foo/passing.bat'):
+      self._FailWithOutput(TestWrapperTest._ReadFile(mf))
+
+    if not rf_dir or not os.path.isdir(rf_dir):
+      self._FailWithOutput(output)
+
+  def _AssertShardedTest(self, output):
     status = None
     index_lines = []
-    for line in stderr + stdout:
-      if line.startswith('STATUS='):
-        status = line[len('STATUS='):]
-      elif line.startswith('INDEX='):
+    for line in output:
+      m = _SHARDED_TEST_RE.match(line)
+      if not m:
+        continue
+      if m.group(1) == 'STATUS':
+        status = m.group(2)
+      else:
         index_lines.append(line)
     if not status:
-      self._FailWithOutput(stderr + stdout)
+      self._FailWithOutput(output)
     # Test test-setup.sh / test wrapper only ensure that the directory of the
     # shard status file exist, not that the file itself does too.
     if not os.path.isdir(os.path.dirname(status)):
-      self._FailWithOutput(stderr + stdout)
-    if sorted(index_lines) != ['INDEX=0 TOTAL=2', 'INDEX=1 TOTAL=2']:
-      self._FailWithOutput(stderr + stdout)
-
-  def _AssertUnexportsEnvvars(self, flag):
-    exit_code, stdout, stderr = self.RunBazel([
-        'test',
-        '//foo:unexported_test.bat',
-        '-t-',
-        '--test_output=all',
-        flag,
-    ])
-    self.AssertExitCode(exit_code, 0, stderr)
-    good = bad = None
-    for line in stderr + stdout:
-      if line.startswith('GOOD='):
-        good = line[len('GOOD='):]
-      elif line.startswith('BAD='):
-        bad = line[len('BAD='):]
-    if not good or bad:
-      self._FailWithOutput(stderr + stdout)
+      self._FailWithOutput(output)
+    # Also check the length, so that a shard printing its line twice fails.
+    if (len(index_lines) != len(_SHARDED_TEST_INDEX_LINES) or
+        frozenset(index_lines) != _SHARDED_TEST_INDEX_LINES):
+      self._FailWithOutput(output)
+
+  def _AssertUnexportsEnvvars(self, output):
+    values = {}
+    for line in output:
+      m = _UNEXPORTED_TEST_RE.match(line)
+      if m:
+        values[m.group(1)] = m.group(2)
+        # GOOD is printed by every shard, so only a leaked BAD value decides
+        # the result early.
+        if values.get('BAD'):
+          break
+    if not values.get('GOOD') or values.get('BAD'):
+      self._FailWithOutput(output)
+
+  def _AssertTests(self, flag):
+    stdout, stderr = self._RunTests(flag)
+    self._AssertPassingTest(stdout, stderr)
+    self._AssertFailingTest(stdout, stderr)
+    self._AssertPrintingTest(self._ReadTestLog('printing_test.bat'))
+    self._AssertRunfiles(self._ReadTestLog('runfiles_test.bat'))
+    self._AssertShardedTest(self._ReadTestLog('sharded_test.bat', 2))
+    self._AssertUnexportsEnvvars(self._ReadTestLog('unexported_test.bat', 2))
 
   def testTestExecutionWithTestSetupSh(self):
-    self._CreateMockWorkspace()
-    flag = '--nowindows_native_test_wrapper'
-    self._AssertPassingTest(flag)
-    self._AssertFailingTest(flag)
-    self._AssertPrintingTest(flag)
-    self._AssertRunfiles(flag)
-    self._AssertShardedTest(flag)
-    self._AssertUnexportsEnvvars(flag)
+    self._AssertTests('--nowindows_native_test_wrapper')
 
   def testTestExecutionWithTestWrapperExe(self):
-    self._CreateMockWorkspace()
     # As of 2018-09-11, the Windows native test runner can run simple tests and
     # export a few envvars, though it does not completely set up the test's
     # environment yet.
-    flag = '--windows_native_test_wrapper'
-    self._AssertPassingTest(flag)
-    self._AssertFailingTest(flag)
-    self._AssertPrintingTest(flag)
-    self._AssertRunfiles(flag)
-    self._AssertShardedTest(flag)
-    self._AssertUnexportsEnvvars(flag)
+    self._AssertTests('--windows_native_test_wrapper')
 
 
 if __name__ == '__main__':